@@ -11,6 +11,7 @@ from utilities.exceptions import AbortScript
 
 from django.contrib.contenttypes.models import ContentType
 from django.db import transaction
+from django.db.models import F, Func, IntegerField
 from django.core.exceptions import ValidationError
 
 from dcim.models import (
@@ -38,6 +39,9 @@ import re
 import os
 import pynetbox
 
+# <A_INTERFACE>=<B_DEVICE>:<B_INTERFACE>
+PATCH_PLAN_LINE_RE = re.compile(r"^([^=]*?)\s*=\s*([^:]*?)\s*:\s*(.*)$")
+
 RACK_FACE_CHOICES = (
     ("front", "Front"),
     ("rear", "Rear"),
@@ -229,6 +233,9 @@ class CommissionDevice(Script):
 
     MGMT_LABEL = "oob-mgmt"
 
+    # All allocation labels, pre-joined for the "nothing matched" warning
+    _ALLOCATION_LABELS_STR = ", ".join(sorted(SINGLE_IP_LABELS | SUBNET_31_LABELS))
+
     #
     # --- Helpers ---
     #
@@ -274,8 +281,9 @@ class CommissionDevice(Script):
     
         return created
 
-    def _normalize(self, s: str) -> str:
-        return (s or "").strip()
+    @staticmethod
+    def _normalize(s: str) -> str:
+        return s.strip() if s else ""
 
     def _slug(self, s: str) -> str:
         """
@@ -296,16 +304,26 @@ class CommissionDevice(Script):
         return f"{site_part}-{network_type_part}-{role_part}-{id_part}"
 
     def _find_site_prefix_by_tag(self, site: Site, tag_name: str) -> Prefix:
-        qs = Prefix.objects.filter(site=site, tags__name=tag_name)
-        if not qs.exists():
+        # Per-run memo: several interfaces may carry the same label
+        key = (site.pk, tag_name)
+        cached = self._prefix_cache.get(key)
+        if cached is not None:
+            return cached
+
+        # Prefer the most specific (longest) prefix; PostgreSQL ranks by masklen() and returns one row
+        best = (
+            Prefix.objects.filter(site=site, tags__name=tag_name)
+            .annotate(prefix_len=Func(F("prefix"), function="masklen", output_field=IntegerField()))
+            .order_by("-prefix_len", "-prefix")
+            .first()
+        )
+        if best is None:
             raise AbortScript(
                 f"No prefix found for site='{site}' with tag='{tag_name}'. "
                 "Ensure Prefix.site is set and the Prefix is tagged correctly."
             )
-        # Prefer the most specific (longest) prefix
-        candidates = list(qs)
-        candidates.sort(key=lambda p: (p.prefix.prefixlen, str(p.prefix)), reverse=True)
-        return candidates[0]
+        self._prefix_cache[key] = best
+        return best
 
     def _allocate_next_ip(self, prefix: Prefix) -> str:
         ip = prefix.get_first_available_ip()
@@ -371,7 +389,7 @@ class CommissionDevice(Script):
 
     def _parse_patch_plan(self, text: str):
         mappings = []
-        if not text:
+        if not text or text.isspace():
             return mappings
 
         for idx, raw in enumerate(text.splitlines(), start=1):
@@ -379,18 +397,14 @@ class CommissionDevice(Script):
             if not line or line.startswith("#"):
                 continue
 
-            if "=" not in line or ":" not in line:
+            m = PATCH_PLAN_LINE_RE.match(line)
+            if not m:
                 raise AbortScript(
                     f"Patch plan line {idx} is invalid: '{raw}'. "
                     "Expected format: <A_INTERFACE>=<B_DEVICE>:<B_INTERFACE>"
                 )
 
-            left, right = line.split("=", 1)
-            b_dev, b_if = right.split(":", 1)
-
-            a_iface = self._normalize(left)
-            b_device = self._normalize(b_dev)
-            b_iface = self._normalize(b_if)
+            a_iface, b_device, b_iface = m.groups()
 
             if not a_iface or not b_device or not b_iface:
                 raise AbortScript(f"Patch plan line {idx} has empty values: '{raw}'")
@@ -414,23 +428,20 @@ class CommissionDevice(Script):
         """
         Create cable between A and B. Any in-use port causes Abort/rollback.
         """
+        a_end = f"{a_iface.device.name}:{a_iface.name}"
+        b_end = f"{b_iface.device.name}:{b_iface.name}"
+
         if self._is_interface_cabled(a_iface):
-            raise AbortScript(
-                f"A-side port already in use: {a_iface.device.name}:{a_iface.name}"
-            )
+            raise AbortScript(f"A-side port already in use: {a_end}")
         if self._is_interface_cabled(b_iface):
-            raise AbortScript(
-                f"B-side port already in use: {b_iface.device.name}:{b_iface.name}"
-            )
+            raise AbortScript(f"B-side port already in use: {b_end}")
 
         Cable.objects.create(
             a_terminations=[a_iface],
             b_terminations=[b_iface],
             status="connected",
         )
-        self.log_success(
-            f"Cabled: {a_iface.device.name}:{a_iface.name} <-> {b_iface.device.name}:{b_iface.name}"
-        )
+        self.log_success(f"Cabled: {a_end} <-> {b_end}")
 
     def _set_iface_desc_and_enable(self, iface: Interface, device_name: str, port_name: str, label: str):
         """
@@ -441,8 +452,7 @@ class CommissionDevice(Script):
 
         iface.description = desc
         iface.enabled = True
-        iface.full_clean()
-        iface.save()
+        iface.save(update_fields=["description", "enabled"])
 
         self.log_success(
             f"Updated {iface.device.name}:{iface.name} (enabled=True, description='{desc}')"
@@ -476,6 +486,9 @@ class CommissionDevice(Script):
     #
 
     def run(self, data, commit):
+        # Script instances may be reused by the worker; never carry lookups over from a previous run
+        self._prefix_cache = {}
+
         region = data["region"]
         site = data["site"]
         tenant = data["tenant"]  # now required
@@ -640,7 +653,7 @@ class CommissionDevice(Script):
             # Primary IPv4 = oob-mgmt IP
             if mgmt_ip_obj:
                 device.primary_ip4 = mgmt_ip_obj
-                device.save()
+                device.save(update_fields=["primary_ip4"])
                 self.log_success(f"Set primary IPv4 for {device.name} to {mgmt_ip_obj.address}")
             else:
                 self.log_warning(
@@ -651,7 +664,7 @@ class CommissionDevice(Script):
                 self.log_warning(
                     "No interfaces matched the requested label policies. "
                     "Labels expected for allocation: "
-                    f"{', '.join(sorted(single_ip_labels | subnet_31_labels))}"
+                    f"{self._ALLOCATION_LABELS_STR}"
                 )
 
             # Optional cabling via patch plan
@@ -670,7 +683,7 @@ class CommissionDevice(Script):
                             "Check the interface name matches exactly in NetBox."
                         )
 
-                    b_dev = Device.objects.filter(name=b_dev_name).first()
+                    b_dev = Device.objects.filter(name=b_dev_name).select_related("site").first()
                     if not b_dev:
                         raise AbortScript(f"B-side device '{b_dev_name}' not found in NetBox.")
 
@@ -685,6 +698,8 @@ class CommissionDevice(Script):
                             f"B-side interface '{b_if_name}' not found on device '{b_dev.name}'. "
                             "Check interface name matches exactly in NetBox."
                         )
+                    # Reuse the Device already in hand so b_iface.device.name never lazy-loads it
+                    b_iface.device = b_dev
 
                     a_label = self._normalize(getattr(a_iface, "label", None))
 
@@ -705,4 +720,5 @@ class CommissionDevice(Script):
                     # Create cable (raises if any side in-use)
                     self._create_cable(a_iface, b_iface)
 
+            self._prefix_cache.clear()
             return f"Commissioning complete for {device.name}."
@@ -9,18 +9,59 @@
 #     eth0=switch-1:Ethernet1/1
 #     eth1=switch-2:Ethernet1/10
 
+import re
+from collections import defaultdict
+
+import netaddr
+from django.db import connection, transaction
+from django.db.models import Prefetch
+from django.db.models.functions import Trim
+
 from extras.scripts import Script, StringVar, ObjectVar, ChoiceVar, BooleanVar, TextVar
 from utilities.exceptions import AbortScript
 
 from dcim.models import Device, DeviceRole, DeviceType, Platform, Site, Interface, Cable
 from dcim.choices import DeviceStatusChoices
 
-from ipam.models import IPAddress, Prefix
-from ipam.choices import IPAddressStatusChoices
+from ipam.models import IPAddress, IPRange, Prefix
+from ipam.choices import IPAddressStatusChoices, PrefixStatusChoices
 from django.contrib.contenttypes.models import ContentType
 from dcim.models.cables import CableTermination
 from tenancy.models import Tenant
 
+# <A_INTERFACE>=<B_DEVICE>:<B_INTERFACE>
+PATCH_PLAN_LINE_RE = re.compile(r"^([^=]*?)\s*=\s*([^:]*?)\s*:\s*(.*)$")
+
+# First free host in [first, last] for a VRF (or across all VRFs), computed in PostgreSQL.
+# Candidates are the first usable host plus the successor of every used host / populated range,
+# so only the gap boundaries are considered and the used set is never shipped to Python.
+NEXT_FREE_IP_SQL = """
+WITH used AS (
+    SELECT DISTINCT host(address)::inet AS ip
+    FROM {ip_table}
+    WHERE (%(any_vrf)s OR vrf_id IS NOT DISTINCT FROM %(vrf_id)s)
+      AND host(address)::inet <<= %(prefix)s::cidr
+),
+ranges AS (
+    SELECT host(start_address)::inet AS lo, host(end_address)::inet AS hi
+    FROM {range_table}
+    WHERE mark_populated
+      AND (%(any_vrf)s OR vrf_id IS NOT DISTINCT FROM %(vrf_id)s)
+      AND host(start_address)::inet <<= %(prefix)s::cidr
+)
+SELECT host(c.ip)
+FROM (
+    SELECT %(first)s::inet AS ip
+    UNION SELECT ip + 1 FROM used WHERE ip < %(last)s::inet
+    UNION SELECT hi + 1 FROM ranges WHERE hi < %(last)s::inet
+) c
+WHERE c.ip BETWEEN %(first)s::inet AND %(last)s::inet
+  AND NOT EXISTS (SELECT 1 FROM used u WHERE u.ip = c.ip)
+  AND NOT EXISTS (SELECT 1 FROM ranges r WHERE c.ip BETWEEN r.lo AND r.hi)
+ORDER BY c.ip
+LIMIT 1
+"""
+
 
 class CommissionDevice(Script):
     class Meta:
@@ -117,38 +158,96 @@ class CommissionDevice(Script):
     )
 
     # Updated tags/labels
-    SUBNET_LABELS = (
+    # frozensets: built once at class load, passed straight to label__in / tags__name__in lookups
+    SUBNET_LABELS = frozenset({
         "idn-mgmt",
         "idn-dmz-a",
         "idn-dmz-b",
         "idn-rtp",
-    )
+    })
     MGMT_LABEL = "idn-mgmt"
+    _MGMT_LABEL_SET = frozenset((MGMT_LABEL,))
+    _SUBNET_LABELS_STR = ", ".join(sorted(SUBNET_LABELS))
 
-    def _normalize(self, s: str) -> str:
-        return (s or "").strip()
+    @staticmethod
+    def _normalize(s: str) -> str:
+        return s.strip() if s else ""
 
-    def _find_site_prefix_by_tag(self, site: Site, tag_name: str) -> Prefix:
-        qs = Prefix.objects.filter(site=site, tags__name=tag_name)
-        if not qs.exists():
+    def _group_site_prefixes_by_tag(self, site: Site, tag_names) -> dict:
+        """
+        Fetch all prefixes at `site` tagged with any of `tag_names` in a single query.
+        The Prefix rows are locked FOR UPDATE (must run inside a transaction), so concurrent
+        commissioning runs allocate from a given prefix one at a time.
+        Returns {tag_name: [Prefix, ...]}; a prefix carrying several of the tags is listed under each.
+        """
+        prefixes_by_tag = defaultdict(list)
+        # Tag match goes in a subquery: FOR UPDATE can't be combined with the DISTINCT the tag join needs
+        tagged = Prefix.objects.filter(site=site, tags__name__in=tag_names).values("pk")
+        qs = (
+            Prefix.objects.filter(pk__in=tagged)
+            .select_for_update(of=("self",))
+            .select_related("vrf", "tenant")  # read when building the IPAddress rows
+            .prefetch_related("tags")
+        )
+        for p in qs:
+            for t in p.tags.all():
+                if t.name in tag_names:
+                    prefixes_by_tag[t.name].append(p)
+        return prefixes_by_tag
+
+    def _pick_site_prefix(self, prefixes_by_tag: dict, site: Site, tag_name: str) -> Prefix:
+        candidates = prefixes_by_tag.get(tag_name)
+        if not candidates:
             raise AbortScript(
                 f"No prefix found for site='{site}' with tag='{tag_name}'. "
                 "Ensure Prefix.site is set and the Prefix is tagged correctly."
             )
-
-        candidates = list(qs)
-        candidates.sort(key=lambda p: (p.prefix.prefixlen, str(p.prefix)), reverse=True)
-        return candidates[0]
+        # Prefer the most specific (longest) prefix
+        return max(candidates, key=lambda p: (p.prefix.prefixlen, p.prefix.first))
 
     def _allocate_next_ip(self, prefix: Prefix) -> str:
-        ip = prefix.get_first_available_ip()
-        if not ip:
+        """
+        Return the next free IP in `prefix` as '<ip>/<prefixlen>'.
+        Gap detection runs in the database (see NEXT_FREE_IP_SQL) instead of building the
+        prefix's used IPSet in Python. Callers hold the Prefix row lock taken by
+        _group_site_prefixes_by_tag(), which serializes concurrent allocations.
+        """
+        if prefix.mark_utilized:
+            raise AbortScript(f"Prefix {prefix.prefix} is marked utilized; no IPs available.")
+
+        net = prefix.prefix
+        first, last = net.first, net.last
+        # Skip network/broadcast unless pool or point-to-point, as Prefix.get_available_ips() does
+        if not prefix.is_pool and net.size > 2:
+            first += 1
+            if net.version == 4:
+                last -= 1
+
+        sql = NEXT_FREE_IP_SQL.format(
+            ip_table=IPAddress._meta.db_table,
+            range_table=IPRange._meta.db_table,
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                sql,
+                {
+                    # A global container matches child IPs/ranges in every VRF (Prefix.get_child_ips())
+                    "any_vrf": prefix.vrf_id is None and prefix.status == PrefixStatusChoices.STATUS_CONTAINER,
+                    "vrf_id": prefix.vrf_id,
+                    "prefix": str(net.cidr),
+                    "first": str(netaddr.IPAddress(first, net.version)),
+                    "last": str(netaddr.IPAddress(last, net.version)),
+                },
+            )
+            row = cursor.fetchone()
+
+        if not row:
             raise AbortScript(f"No available IPs left in prefix {prefix.prefix}.")
-        return str(ip)
+        return f"{row[0]}/{net.prefixlen}"
 
     def _parse_patch_plan(self, text: str):
         mappings = []
-        if not text:
+        if not text or text.isspace():
             return mappings
 
         for idx, raw in enumerate(text.splitlines(), start=1):
@@ -156,18 +255,14 @@ class CommissionDevice(Script):
             if not line or line.startswith("#"):
                 continue
 
-            if "=" not in line or ":" not in line:
+            m = PATCH_PLAN_LINE_RE.match(line)
+            if not m:
                 raise AbortScript(
                     f"Patch plan line {idx} is invalid: '{raw}'. "
                     "Expected format: <A_INTERFACE>=<B_DEVICE>:<B_INTERFACE>"
                 )
 
-            left, right = line.split("=", 1)
-            b_dev, b_if = right.split(":", 1)
-
-            a_iface = self._normalize(left)
-            b_device = self._normalize(b_dev)
-            b_iface = self._normalize(b_if)
+            a_iface, b_device, b_iface = m.groups()
 
             if not a_iface or not b_device or not b_iface:
                 raise AbortScript(f"Patch plan line {idx} has empty values: '{raw}'")
@@ -176,18 +271,74 @@ class CommissionDevice(Script):
 
         return mappings
 
+    def _fetch_b_side_devices(self, mappings) -> dict:
+        """
+        Load every B-side device named in the patch plan, plus the referenced interfaces, in two queries.
+        Device names are only unique per site/tenant; the first match is kept, as with .first().
+        Returns {device_name: Device}; each Device carries `_pp_ifaces`, the matching interfaces.
+        """
+        b_dev_names = {m[1] for m in mappings}
+        b_if_names = {m[2] for m in mappings}
+        iface_qs = Interface.objects.filter(name__in=b_if_names)
+        qs = (
+            Device.objects.filter(name__in=b_dev_names)
+            .select_related("site")
+            .prefetch_related(Prefetch("interfaces", queryset=iface_qs, to_attr="_pp_ifaces"))
+        )
+        devices = {}
+        for d in qs:
+            devices.setdefault(d.name, d)
+        return devices
+
+    def _resolve_patch_plan(self, mappings, device_type: DeviceType, site: Site, enforce_site_match: bool):
+        """
+        Validate every patch-plan mapping before anything is written.
+        A-side names are checked against the DeviceType interface templates (the device doesn't exist yet);
+        B-side devices/interfaces are resolved in bulk.
+        Returns list of tuples: (a_iface_name, b_iface)
+        """
+        a_template_names = set(device_type.interfacetemplates.values_list("name", flat=True))
+        b_devices = self._fetch_b_side_devices(mappings)
+
+        resolved = []
+        for a_name, b_dev_name, b_if_name in mappings:
+            if a_name not in a_template_names:
+                raise AbortScript(
+                    f"A-side interface '{a_name}' is not defined on device type '{device_type}'. "
+                    "Check the interface name matches exactly in NetBox."
+                )
+
+            b_dev = b_devices.get(b_dev_name)
+            if not b_dev:
+                raise AbortScript(f"B-side device '{b_dev_name}' not found in NetBox.")
+
+            if enforce_site_match and b_dev.site_id != site.id:
+                raise AbortScript(
+                    f"B-side device '{b_dev.name}' is in site '{b_dev.site}', not '{site}'."
+                )
+
+            b_iface = next((i for i in b_dev._pp_ifaces if i.name == b_if_name), None)
+            if not b_iface:
+                raise AbortScript(
+                    f"B-side interface '{b_if_name}' not found on device '{b_dev.name}'. "
+                    "Check interface name matches exactly in NetBox."
+                )
+            resolved.append((a_name, b_iface))
+
+        return resolved
+
     def _create_cable(self, a_iface: Interface, b_iface: Interface) -> bool:
-        if getattr(b_iface, "cable", None):
-            self.log_warning(
-                f"Skipping (B-Side switch port is already in use): {b_iface.device.name}:{b_iface.name}"
-            )
+        b_end = f"{b_iface.device.name}:{b_iface.name}"
+        if b_iface.cable_id:
+            self.log_warning(f"Skipping (B-Side switch port is already in use): {b_end}")
             return False
 
-        Cable.objects.create(
+        cable = Cable.objects.create(
             a_terminations=[a_iface],
             b_terminations=[b_iface],
             status="connected",
         )
+        b_iface.cable = cable  # CableTermination.save() only updates a fresh copy
         # a_device = a_iface.device.name
         # a_port = a_iface.name
         # a_label = (a_iface.label or "").strip()
@@ -197,21 +348,22 @@ class CommissionDevice(Script):
         # b_iface.description = desc
         # b_iface.full_clean()
         # b_iface.save()
-        self.log_success(
-            f"Cabled: {a_iface.device.name}:{a_iface.name} <-> {b_iface.device.name}:{b_iface.name}"
-        )
+        self.log_success(f"Cabled: {a_iface.device.name}:{a_iface.name} <-> {b_end}")
         return True
 
-    def _is_interface_cabled(self, iface: Interface) -> bool:
+    def _cabled_interface_ids(self, ifaces) -> set:
         """
-        Return True if the interface already has a cable attached.
+        Return the pks of `ifaces` that already have a cable attached, in one query.
         NetBox 4.x requires querying CableTermination via GenericFK fields.
         """
-        ct = ContentType.objects.get_for_model(iface.__class__)
-        return CableTermination.objects.filter(
-            termination_type=ct,
-            termination_id=iface.pk,
-        ).exists()
+        ct = ContentType.objects.get_for_model(Interface)
+        return set(
+            CableTermination.objects.filter(
+                termination_type=ct,
+                termination_id__in=[i.pk for i in ifaces],
+            ).values_list("termination_id", flat=True)
+        )
+
     def _set_iface_desc_and_enable(self, iface: Interface, device_name: str, port_name: str, label: str):
         """
         Set interface enabled=True and description to: <device_name>-<port_name>-<label>
@@ -221,8 +373,7 @@ class CommissionDevice(Script):
     
         iface.description = desc
         iface.enabled = True
-        iface.full_clean()
-        iface.save()
+        iface.save(update_fields=["description", "enabled"])
     
         self.log_success(
             f"Updated {iface.device.name}:{iface.name} (enabled=True, description='{desc}')"
@@ -246,166 +397,184 @@ class CommissionDevice(Script):
         if Device.objects.filter(name=hostname).exists():
             raise AbortScript(f"Device name '{hostname}' already exists in NetBox.")
 
+        # Validate the whole patch plan up front: bad input aborts before any write
+        patch_links = []
+        if do_cabling:
+            mappings = self._parse_patch_plan(patch_plan_text)
+            if not mappings:
+                raise AbortScript("Cabling enabled but patch plan is empty. Add at least one mapping line.")
+            patch_links = self._resolve_patch_plan(mappings, device_type, site, enforce_site_match)
+
         if not commit:
             self.log_info("[DRY-RUN] Would create device, allocate IPs, and optionally create cables.")
             return "Dry-run complete."
 
-        device = Device(
-            name=hostname,
-            site=site,
-            platform=platform,
-            device_type=device_type,
-            role=role,
-            tenant=tenant,
-            status=status,
-        )
-        device.full_clean()
-        device.save()
-        self.log_success(f"Created device: {device.name} (site={site}, type={device_type}, platform={platform})")
-
-        interfaces = list(device.interfaces.all())
-        if not interfaces:
-            raise AbortScript(
-                "No interfaces found on device after creation. "
-                "Check that the Device Type has interface templates defined."
-            )
-
-        target_labels = set(self.SUBNET_LABELS) if allocate_all else {self.MGMT_LABEL}
-
-        target_ifaces = []
-        for iface in interfaces:
-            if getattr(iface, "label", None) and iface.label.strip() in target_labels:
-                target_ifaces.append(iface)
-
-        if not target_ifaces:
-            raise AbortScript(
-                "No interfaces matched the required labels. "
-                "Ensure Interface.label matches one of: "
-                f"{', '.join(sorted(target_labels))}"
+        # Atomic transaction - any AbortScript or exception will roll back all DB changes
+        with transaction.atomic():
+            device = Device(
+                name=hostname,
+                site=site,
+                platform=platform,
+                device_type=device_type,
+                role=role,
+                tenant=tenant,
+                status=status,
             )
+            device.full_clean()
+            device.save()
+            self.log_success(f"Created device: {device.name} (site={site}, type={device_type}, platform={platform})")
+
+            if do_cabling:
+                # The patch plan needs full rows for every interface (A-side ports are cleaned/saved), so fetch
+                # them once and reuse them for label matching too
+                interfaces = list(device.interfaces.all())
+                has_interfaces = bool(interfaces)
+            else:
+                interfaces = None
+                has_interfaces = device.interfaces.exists()
+
+            if not has_interfaces:
+                raise AbortScript(
+                    "No interfaces found on device after creation. "
+                    "Check that the Device Type has interface templates defined."
+                )
 
-        mgmt_ip_obj = None
-
-        for iface in target_ifaces:
-            label = iface.label.strip()
-            prefix = self._find_site_prefix_by_tag(site, label)
-            addr = self._allocate_next_ip(prefix)
+            target_labels = self.SUBNET_LABELS if allocate_all else self._MGMT_LABEL_SET
+
+            # (interface, normalized label) pairs, so each label is stripped once
+            if interfaces is not None:
+                target_ifaces = [
+                    (i, label) for i in interfaces if (label := (i.label or "").strip()) in target_labels
+                ]
+            else:
+                # Filter by (trimmed) label in the database and load only what is read; Interface rows are wide
+                target_ifaces = [
+                    (i, i.label_trimmed)
+                    for i in device.interfaces.annotate(label_trimmed=Trim("label"))
+                    .filter(label_trimmed__in=target_labels)
+                    .only("id", "device", "name", "label")
+                ]
+
+            if not target_ifaces:
+                raise AbortScript(
+                    "No interfaces matched the required labels. "
+                    "Ensure Interface.label matches one of: "
+                    f"{self._SUBNET_LABELS_STR if allocate_all else self.MGMT_LABEL}"
+                )
 
-            ip_obj = IPAddress(
-                address=addr,
-                vrf=prefix.vrf,
-                tenant=tenant or prefix.tenant,
-                status=IPAddressStatusChoices.STATUS_ACTIVE,
-                assigned_object=iface,
-            )
-            ip_obj.full_clean()
-            ip_obj.save()
+            prefixes_by_tag = self._group_site_prefixes_by_tag(site, target_labels)
+            # Resolve every (interface, label, prefix) before writing, so a missing prefix aborts with no IPs created
+            plan = []
+            for iface, label in target_ifaces:
+                plan.append((iface, label, self._pick_site_prefix(prefixes_by_tag, site, label)))
 
-            self.log_success(
-                f"Assigned {ip_obj.address} to {device.name} / {iface.name} (label={label}, prefix={prefix.prefix})"
-            )
+            mgmt_ip_obj = None
 
-            if label == self.MGMT_LABEL:
-                mgmt_ip_obj = ip_obj
+            # Saved one by one: each allocation must see the rows inserted before it
+            for iface, label, prefix in plan:
+                addr = self._allocate_next_ip(prefix)
 
-        if mgmt_ip_obj:
-            device.primary_ip4 = mgmt_ip_obj
-            device.save()
-            self.log_success(f"Set primary IPv4 for {device.name} to {mgmt_ip_obj.address}")
-        else:
-            self.log_warning(f"No '{self.MGMT_LABEL}' interface allocated; primary IPv4 not set.")
+                ip_obj = IPAddress(
+                    address=addr,
+                    vrf=prefix.vrf,
+                    tenant=tenant or prefix.tenant,
+                    status=IPAddressStatusChoices.STATUS_ACTIVE,
+                    assigned_object=iface,
+                )
+                ip_obj.full_clean(exclude=["assigned_object_type", "assigned_object_id"])  # saved Interface
+                ip_obj.save()
 
-        if do_cabling:
-            mappings = self._parse_patch_plan(patch_plan_text)
-            if not mappings:
-                raise AbortScript("Cabling enabled but patch plan is empty. Add at least one mapping line.")
+                self.log_success(
+                    f"Assigned {ip_obj.address} to {device.name} / {iface.name} (label={label}, prefix={prefix.prefix})"
+                )
 
-            a_if_by_name = {i.name: i for i in device.interfaces.all()}
-
-            created = 0
-            skipped = 0
-
-            for a_name, b_dev_name, b_if_name in mappings:
-                a_iface = a_if_by_name.get(a_name)
-                if not a_iface:
-                    raise AbortScript(
-                        f"A-side interface '{a_name}' not found on new device '{device.name}'. "
-                        "Check the interface name matches exactly in NetBox."
-                    )
-
-                b_dev = Device.objects.filter(name=b_dev_name).first()
-                if not b_dev:
-                    raise AbortScript(f"B-side device '{b_dev_name}' not found in NetBox.")
-
-                if enforce_site_match and b_dev.site_id != site.id:
-                    raise AbortScript(
-                        f"B-side device '{b_dev.name}' is in site '{b_dev.site}', not '{site}'."
-                    )
-
-                b_iface = Interface.objects.filter(device=b_dev, name=b_if_name).first()
-                if not b_iface:
-                    raise AbortScript(
-                        f"B-side interface '{b_if_name}' not found on device '{b_dev.name}'. "
-                        "Check interface name matches exactly in NetBox."
-                    )
-                a_label = (a_iface.label or "").strip() 
-                # B-side desc = A-device, A-port, A-label
-                # self._set_iface_desc_and_enable(
-                #     iface=b_iface,
-                #     device_name=a_iface.device.name,
-                #     port_name=a_iface.name,
-                #     label=a_label,
-                # )
-
-                if self._is_interface_cabled(b_iface):
-                    self.log_warning(
-                        f"Skipping description update (B-side Port is already in use/cabled): "
-                        f"{b_iface.device.name}:{b_iface.name}"
-                    )
-                else:
+                if label == self.MGMT_LABEL:
+                    mgmt_ip_obj = ip_obj
+
+            if mgmt_ip_obj:
+                device.primary_ip4 = mgmt_ip_obj
+                device.save(update_fields=["primary_ip4"])
+                self.log_success(f"Set primary IPv4 for {device.name} to {mgmt_ip_obj.address}")
+            else:
+                self.log_warning(f"No '{self.MGMT_LABEL}' interface allocated; primary IPv4 not set.")
+
+            if do_cabling:
+                a_if_by_name = {i.name: i for i in interfaces}
+
+                links = []
+                for a_name, b_iface in patch_links:
+                    a_iface = a_if_by_name.get(a_name)
+                    if not a_iface:
+                        raise AbortScript(
+                            f"A-side interface '{a_name}' not found on new device '{device.name}'. "
+                            "Check the interface name matches exactly in NetBox."
+                        )
+                    links.append((a_iface, b_iface))
+
+                created = 0
+                skipped = 0
+                cabled_b_ids = self._cabled_interface_ids(b for _, b in links)
+
+                for a_iface, b_iface in links:
+                    a_label = (a_iface.label or "").strip()
                     # B-side desc = A-device, A-port, A-label
-                    self._set_iface_desc_and_enable(
-                        iface=b_iface,
-                        device_name=a_iface.device.name,
-                        port_name=a_iface.name,
-                        label=a_label,
-                    )
-                    # A-side desc = B-device, B-port, A-label
-                    self._set_iface_desc_and_enable(
-                        iface=a_iface,
-                        device_name=b_iface.device.name,
-                        port_name=b_iface.name,
-                        label=a_label,
-                    )
-
-                if self._create_cable(a_iface, b_iface):
-                    created += 1
-                else:
-                    skipped += 1
+                    # self._set_iface_desc_and_enable(
+                    #     iface=b_iface,
+                    #     device_name=a_iface.device.name,
+                    #     port_name=a_iface.name,
+                    #     label=a_label,
+                    # )
+
+                    if b_iface.pk in cabled_b_ids:
+                        self.log_warning(
+                            f"Skipping description update (B-side Port is already in use/cabled): "
+                            f"{b_iface.device.name}:{b_iface.name}"
+                        )
+                    else:
+                        # B-side desc = A-device, A-port, A-label
+                        self._set_iface_desc_and_enable(
+                            iface=b_iface,
+                            device_name=a_iface.device.name,
+                            port_name=a_iface.name,
+                            label=a_label,
+                        )
+                        # A-side desc = B-device, B-port, A-label
+                        self._set_iface_desc_and_enable(
+                            iface=a_iface,
+                            device_name=b_iface.device.name,
+                            port_name=b_iface.name,
+                            label=a_label,
+                        )
+
+                    if self._create_cable(a_iface, b_iface):
+                        cabled_b_ids.add(b_iface.pk)  # the same B port may appear twice in a plan
+                        created += 1
+                    else:
+                        skipped += 1
                            
-                # cable_status = self._create_cable(a_iface, b_iface)
-                # if cable_status:
-                #     created += 1
-                #     a_label = (a_iface.label or "").strip() 
-                #     # B-side desc = A-device, A-port, A-label
-                #     self._set_iface_desc_and_enable(
-                #         iface=b_iface,
-                #         device_name=a_iface.device.name,
-                #         port_name=a_iface.name,
-                #         label=a_label,
-                #     )
+                    # cable_status = self._create_cable(a_iface, b_iface)
+                    # if cable_status:
+                    #     created += 1
+                    #     a_label = (a_iface.label or "").strip() 
+                    #     # B-side desc = A-device, A-port, A-label
+                    #     self._set_iface_desc_and_enable(
+                    #         iface=b_iface,
+                    #         device_name=a_iface.device.name,
+                    #         port_name=a_iface.name,
+                    #         label=a_label,
+                    #     )
                 
-                #     # A-side desc = B-device, B-port, A-label
-                #     self._set_iface_desc_and_enable(
-                #         iface=a_iface,
-                #         device_name=b_iface.device.name,
-                #         port_name=b_iface.name,
-                #         label=a_label,
-                #     )
-                # else:
-                #     skipped += 1
+                    #     # A-side desc = B-device, B-port, A-label
+                    #     self._set_iface_desc_and_enable(
+                    #         iface=a_iface,
+                    #         device_name=b_iface.device.name,
+                    #         port_name=b_iface.name,
+                    #         label=a_label,
+                    #     )
+                    # else:
+                    #     skipped += 1
                     
 
-            self.log_info(f"Patch plan cabling summary: created={created}, skipped={skipped}")
+                self.log_info(f"Patch plan cabling summary: created={created}, skipped={skipped}")
 
-        return f"Commissioning complete for {device.name}."
+            return f"Commissioning complete for {device.name}."
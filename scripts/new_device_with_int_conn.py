@@ -12,6 +12,13 @@
 # - Prefix selection uses tags on Prefix matching interface labels.
 # - Sorting prefixes by prefixlen is done in Python (no prefix_length DB field in 3.7.x).
 
+import re
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, Q
+from django.db.models.functions import Trim
+
 from extras.scripts import Script, StringVar, ObjectVar, ChoiceVar, BooleanVar, TextVar
 from utilities.exceptions import AbortScript
 
@@ -20,6 +27,10 @@ from ipam.models import IPAddress, Prefix
 from tenancy.models import Tenant
 
 
+# <A_INTERFACE>=<B_DEVICE>:<B_INTERFACE>
+PATCH_PLAN_LINE_RE = re.compile(r"^([^=]*?)\s*=\s*([^:]*?)\s*:\s*(.*)$")
+
+
 class CommissionDevice(Script):
     class Meta:
         name = "Commission New Device (IP Allocation + Patch Plan Cabling)"
@@ -139,45 +150,68 @@ class CommissionDevice(Script):
     # Allocation configuration
     # ----------------------------
 
-    SUBNET_LABELS = (
+    SUBNET_LABELS = frozenset({
         "mgmt_subnet",
         "dmz_a_subnet",
         "dmz_b_subnet",
         "rtp_subnet",
-    )
+    })
     MGMT_LABEL = "mgmt_subnet"
+    _MGMT_LABEL_SET = frozenset((MGMT_LABEL,))
+    _SUBNET_LABELS_STR = ", ".join(sorted(SUBNET_LABELS))
 
     # ----------------------------
     # Helpers
     # ----------------------------
 
-    def _normalize(self, s: str) -> str:
-        return (s or "").strip()
+    @staticmethod
+    def _normalize(s: str) -> str:
+        return s.strip() if s else ""
 
-    def _find_prefix(self, site: Site, tag_name: str, allow_global_fallback: bool) -> Prefix:
-        qs_site = Prefix.objects.filter(site=site, tags__name=tag_name)
+    def _most_specific_by_tag(self, qs, tag_names) -> dict:
+        """
+        Evaluate `qs` once and keep the most specific (longest) prefix per tag in `tag_names`.
+        Returns dict: {tag_name: Prefix}
+        """
+        by_tag = defaultdict(list)
+        for p in qs.distinct().select_related("vrf", "tenant").prefetch_related("tags"):
+            for t in p.tags.all():
+                if t.name in tag_names:
+                    by_tag[t.name].append(p)
+        return {t: max(ps, key=lambda p: (p.prefix.prefixlen, p.prefix.first)) for t, ps in by_tag.items()}
+
+    def _find_prefixes_bulk(self, site: Site, tag_names, allow_global_fallback: bool) -> dict:
+        """
+        Resolve the prefix for every tag in `tag_names`: one query for the site, plus one for the
+        global pool (Prefix.site is empty) if fallback is enabled and some tags are still missing.
+        Returns dict: {tag_name: Prefix}
+        """
+        chosen = self._most_specific_by_tag(Prefix.objects.filter(site=site, tags__name__in=tag_names), tag_names)
+        scopes = dict.fromkeys(chosen, f"site={site}")
 
-        if qs_site.exists():
-            candidates = list(qs_site)
-            scope = f"site={site}"
-        elif allow_global_fallback:
-            qs_global = Prefix.objects.filter(site__isnull=True, tags__name=tag_name)
-            if qs_global.exists():
-                candidates = list(qs_global)
-                scope = "site=NULL (global)"
+        missing = sorted(set(tag_names) - chosen.keys())
+        if missing and allow_global_fallback:
+            found = self._most_specific_by_tag(
+                Prefix.objects.filter(site__isnull=True, tags__name__in=missing), missing
+            )
+            for tag_name, prefix in found.items():
                 self.log_warning(
                     f"No site-scoped prefix found for site='{site}' tag='{tag_name}'. Falling back to global pool."
                 )
-            else:
-                candidates = []
-                scope = None
-        else:
-            candidates = []
-            scope = None
-
-        if not candidates:
-            site_prefix_count = Prefix.objects.filter(site=site).count()
-            tag_prefix_count = Prefix.objects.filter(tags__name=tag_name).count()
+                chosen[tag_name] = prefix
+                scopes[tag_name] = "site=NULL (global)"
+            missing = [t for t in missing if t not in found]
+
+        if missing:
+            tag_name = missing[0]
+            # Diagnostics only on the failure path, both counts in one round-trip
+            # (distinct: the tag join repeats a prefix once per tag)
+            counts = Prefix.objects.aggregate(
+                site_prefix_count=Count("pk", filter=Q(site=site), distinct=True),
+                tag_prefix_count=Count("pk", filter=Q(tags__name=tag_name), distinct=True),
+            )
+            site_prefix_count = counts["site_prefix_count"]
+            tag_prefix_count = counts["tag_prefix_count"]
             raise AbortScript(
                 f"No prefix found for site='{site}' with tag='{tag_name}'. "
                 f"Debug: prefixes at site='{site}': {site_prefix_count}, "
@@ -185,18 +219,25 @@ class CommissionDevice(Script):
                 "Fix Prefix.site and Prefix.tags (or enable global fallback)."
             )
 
-        candidates.sort(key=lambda p: (p.prefix.prefixlen, str(p.prefix)), reverse=True)
-        chosen = candidates[0]
-        self.log_info(f"Using prefix {chosen.prefix} ({scope}, tag={tag_name})")
+        for tag_name in sorted(chosen):
+            self.log_info(f"Using prefix {chosen[tag_name].prefix} ({scopes[tag_name]}, tag={tag_name})")
         return chosen
 
     def _allocate_next_ip_str(self, prefix: Prefix) -> str:
-        ip = prefix.get_first_available_ip()
-        if not ip:
+        # get_available_ips() rebuilds the prefix's used set on every call; build it once per prefix
+        # per run and hand out addresses from an iterator over the resulting IPSet.
+        available = self._available_ips.get(prefix.pk)
+        if available is None:
+            available = self._available_ips[prefix.pk] = iter(prefix.get_available_ips())
+        ip = next(available, None)
+        if ip is None:
             raise AbortScript(f"No available IPs left in prefix {prefix.prefix}.")
-        return str(ip)
+        return f"{ip}/{prefix.prefix.prefixlen}"
 
-    def _assign_ip_to_interface(self, iface: Interface, prefix: Prefix, tenant: Tenant = None) -> IPAddress:
+    def _build_ip_for_interface(self, iface: Interface, prefix: Prefix, tenant: Tenant = None) -> IPAddress:
+        """
+        Allocate the next free IP from `prefix` and return a validated, *unsaved* IPAddress for `iface`.
+        """
         addr = self._allocate_next_ip_str(prefix)
         ip_obj = IPAddress(
             address=addr,
@@ -205,8 +246,7 @@ class CommissionDevice(Script):
             status="active",
             assigned_object=iface,
         )
-        ip_obj.full_clean()
-        ip_obj.save()
+        ip_obj.full_clean(exclude=["assigned_object_type", "assigned_object_id"])  # saved Interface
         return ip_obj
 
     def _parse_patch_plan(self, text: str):
@@ -216,7 +256,7 @@ class CommissionDevice(Script):
         Returns list of tuples: (a_iface_name, b_device_name, b_iface_name)
         """
         mappings = []
-        if not text:
+        if not text or text.isspace():
             return mappings
 
         for idx, raw in enumerate(text.splitlines(), start=1):
@@ -224,18 +264,14 @@ class CommissionDevice(Script):
             if not line or line.startswith("#"):
                 continue
 
-            if "=" not in line or ":" not in line:
+            m = PATCH_PLAN_LINE_RE.match(line)
+            if not m:
                 raise AbortScript(
                     f"Patch plan line {idx} is invalid: '{raw}'. "
                     "Expected format: <A_INTERFACE>=<B_DEVICE>:<B_INTERFACE>"
                 )
 
-            left, right = line.split("=", 1)
-            b_dev, b_if = right.split(":", 1)
-
-            a_iface = self._normalize(left)
-            b_device = self._normalize(b_dev)
-            b_iface = self._normalize(b_if)
+            a_iface, b_device, b_iface = m.groups()
 
             if not a_iface or not b_device or not b_iface:
                 raise AbortScript(f"Patch plan line {idx} has empty values: '{raw}'")
@@ -244,22 +280,40 @@ class CommissionDevice(Script):
 
         return mappings
 
+    def _fetch_b_side_interfaces(self, mappings):
+        """
+        Load every B-side device and interface referenced by the patch plan in two queries.
+        Returns (devices_by_name, interfaces_by_(device_id, name)).
+        """
+        dev_qs = Device.objects.filter(name__in={m[1] for m in mappings}).select_related("site")
+        b_devs = {}
+        for d in dev_qs:
+            b_devs.setdefault(d.name, d)  # first match, as with .first()
+        devs_by_id = {d.pk: d for d in b_devs.values()}
+
+        b_ifaces = {}
+        qs = Interface.objects.filter(device_id__in=devs_by_id, name__in={m[2] for m in mappings})
+        for iface in qs:
+            iface.device = devs_by_id[iface.device_id]  # reuse the loaded Device for log messages
+            b_ifaces[(iface.device_id, iface.name)] = iface
+        return b_devs, b_ifaces
+
     def _create_cable(self, a_iface: Interface, b_iface: Interface):
+        link = f"{a_iface.device.name}:{a_iface.name} <-> {b_iface.device.name}:{b_iface.name}"
+
         # Skip if already cabled
-        if getattr(a_iface, "cable", None) or getattr(b_iface, "cable", None):
-            self.log_info(
-                f"Skipping (already cabled): {a_iface.device.name}:{a_iface.name} <-> {b_iface.device.name}:{b_iface.name}"
-            )
+        if a_iface.cable_id or b_iface.cable_id:
+            self.log_info(f"Skipping (already cabled): {link}")
             return False
 
-        Cable.objects.create(
+        cable = Cable.objects.create(
             a_terminations=[a_iface],
             b_terminations=[b_iface],
             status="connected",
         )
-        self.log_success(
-            f"Cabled: {a_iface.device.name}:{a_iface.name} <-> {b_iface.device.name}:{b_iface.name}"
-        )
+        # CableTermination.save() only updates fresh copies; a port may appear again later in the plan
+        a_iface.cable = b_iface.cable = cable
+        self.log_success(f"Cabled: {link}")
         return True
 
     # ----------------------------
@@ -267,6 +321,9 @@ class CommissionDevice(Script):
     # ----------------------------
 
     def run(self, data, commit):
+        # {prefix pk: iterator of free IPs}; per run only, Script instances may be reused
+        self._available_ips = {}
+
         hostname = self._normalize(data["hostname"])
         site = data["site"]
         platform = data["platform"]
@@ -289,109 +346,137 @@ class CommissionDevice(Script):
             self.log_info("[DRY-RUN] Would create device, allocate IPs, and optionally create cables.")
             return "Dry-run complete."
 
-        # ---- create device ----
-        device = Device(
-            name=hostname,
-            site=site,
-            platform=platform,
-            device_type=device_type,
-            role=role,
-            tenant=tenant,
-            status=status,
-        )
-        device.full_clean()
-        device.save()
-        self.log_success(f"Created device: {device.name} (site={site}, type={device_type}, platform={platform})")
-
-        # ---- ensure interfaces exist ----
-        interfaces = list(device.interfaces.all())
-        if not interfaces:
-            raise AbortScript(
-                "No interfaces found on device after creation. "
-                "Check that the Device Type has interface templates defined."
+        # Atomic transaction - any AbortScript or exception will roll back all DB changes
+        with transaction.atomic():
+            # ---- create device ----
+            device = Device(
+                name=hostname,
+                site=site,
+                platform=platform,
+                device_type=device_type,
+                role=role,
+                tenant=tenant,
+                status=status,
             )
+            device.full_clean()
+            device.save()
+            self.log_success(f"Created device: {device.name} (site={site}, type={device_type}, platform={platform})")
+
+            # ---- ensure interfaces exist ----
+            if do_cabling:
+                # Fetched once and reused for cabling: patch-plan A-side ports get cabled (and snapshotted),
+                # which needs full rows kept in memory
+                interfaces = list(device.interfaces.all())
+                has_interfaces = bool(interfaces)
+            else:
+                interfaces = None
+                has_interfaces = device.interfaces.exists()
 
-        # ---- IP allocation ----
-        target_labels = set(self.SUBNET_LABELS) if allocate_all else {self.MGMT_LABEL}
+            if not has_interfaces:
+                raise AbortScript(
+                    "No interfaces found on device after creation. "
+                    "Check that the Device Type has interface templates defined."
+                )
 
-        target_ifaces = []
-        for iface in interfaces:
-            label = self._normalize(getattr(iface, "label", None))
-            if label in target_labels:
-                target_ifaces.append(iface)
+            # ---- IP allocation ----
+            target_labels = self.SUBNET_LABELS if allocate_all else self._MGMT_LABEL_SET
 
-        if not target_ifaces:
-            raise AbortScript(
-                "No interfaces matched the required labels. "
-                "Ensure Interface.label matches one of: "
-                f"{', '.join(sorted(target_labels))}"
-            )
+            if interfaces is not None:
+                target_ifaces = [
+                    (i, label) for i in interfaces if (label := self._normalize(i.label)) in target_labels
+                ]
+            else:
+                target_ifaces = [
+                    (i, i.label_trimmed)
+                    for i in device.interfaces.annotate(label_trimmed=Trim("label"))
+                    .filter(label_trimmed__in=target_labels)
+                    .only("id", "device", "name", "label")
+                ]
+
+            if not target_ifaces:
+                raise AbortScript(
+                    "No interfaces matched the required labels. "
+                    "Ensure Interface.label matches one of: "
+                    f"{self._SUBNET_LABELS_STR if allocate_all else self.MGMT_LABEL}"
+                )
 
-        mgmt_ip_obj = None
-        for iface in target_ifaces:
-            label = self._normalize(iface.label)
-            prefix = self._find_prefix(site, label, allow_global_fallback)
-            ip_obj = self._assign_ip_to_interface(iface, prefix, tenant=tenant)
-            self.log_success(
-                f"Assigned {ip_obj.address} to {device.name}/{iface.name} (label={label}, prefix={prefix.prefix})"
+            prefixes = self._find_prefixes_bulk(site, {label for _, label in target_ifaces}, allow_global_fallback)
+            # Row-lock the chosen prefixes until commit, so concurrent runs allocating from the same pool
+            # compute available IPs one after another instead of handing out the same address
+            list(
+                Prefix.objects.select_for_update()
+                .filter(pk__in=[p.pk for p in prefixes.values()])
+                .values_list("pk", flat=True)
             )
-            if label == self.MGMT_LABEL:
-                mgmt_ip_obj = ip_obj
 
-        if mgmt_ip_obj:
-            device.primary_ip4 = mgmt_ip_obj
-            device.save()
-            self.log_success(f"Set primary IPv4 for {device.name} to {mgmt_ip_obj.address}")
-        else:
-            self.log_warning(f"No '{self.MGMT_LABEL}' interface allocated; primary IPv4 not set.")
-
-        # ---- Cabling from patch plan ----
-        if do_cabling:
-            mappings = self._parse_patch_plan(patch_plan_text)
-            if not mappings:
-                raise AbortScript("Cabling enabled but patch plan is empty. Add at least one mapping line.")
-
-            # Build lookup for A-side interfaces on the newly created device
-            a_if_by_name = {i.name: i for i in device.interfaces.all()}
-
-            created = 0
-            skipped = 0
-
-            for a_name, b_dev_name, b_if_name in mappings:
-                a_iface = a_if_by_name.get(a_name)
-                if not a_iface:
-                    raise AbortScript(
-                        f"A-side interface '{a_name}' not found on new device '{device.name}'. "
-                        "Check the interface name matches exactly in NetBox."
-                    )
-
-                # Find B-side device by name
-                b_dev_qs = Device.objects.filter(name=b_dev_name)
-                if not b_dev_qs.exists():
-                    raise AbortScript(f"B-side device '{b_dev_name}' not found in NetBox.")
-                b_dev = b_dev_qs.first()
-
-                if enforce_site_match and b_dev.site_id != site.id:
-                    raise AbortScript(
-                        f"B-side device '{b_dev.name}' is in site '{b_dev.site}', not '{site}'."
-                    )
-
-                # Find B-side interface
-                b_iface_qs = Interface.objects.filter(device=b_dev, name=b_if_name)
-                if not b_iface_qs.exists():
-                    raise AbortScript(
-                        f"B-side interface '{b_if_name}' not found on device '{b_dev.name}'. "
-                        "Check interface name matches exactly in NetBox."
-                    )
-                b_iface = b_iface_qs.first()
-
-                # Create cable
-                ok = self._create_cable(a_iface, b_iface)
-                if ok:
-                    created += 1
-                else:
-                    skipped += 1
-
-            self.log_info(f"Patch plan cabling summary: created={created}, skipped={skipped}")
-
-        return f"Commissioning complete for {device.name}."
+            # Allocate and validate every address first, so a bad row aborts before any IP is written
+            planned = []
+            for iface, label in target_ifaces:
+                prefix = prefixes[label]
+                planned.append((iface, label, prefix, self._build_ip_for_interface(iface, prefix, tenant=tenant)))
+
+            mgmt_ip_obj = None
+            for iface, label, prefix, ip_obj in planned:
+                ip_obj.save()
+                self.log_success(
+                    f"Assigned {ip_obj.address} to {device.name}/{iface.name} (label={label}, prefix={prefix.prefix})"
+                )
+                if label == self.MGMT_LABEL:
+                    mgmt_ip_obj = ip_obj
+
+            if mgmt_ip_obj:
+                device.primary_ip4 = mgmt_ip_obj
+                device.save(update_fields=["primary_ip4"])
+                self.log_success(f"Set primary IPv4 for {device.name} to {mgmt_ip_obj.address}")
+            else:
+                self.log_warning(f"No '{self.MGMT_LABEL}' interface allocated; primary IPv4 not set.")
+
+            # ---- Cabling from patch plan ----
+            if do_cabling:
+                mappings = self._parse_patch_plan(patch_plan_text)
+                if not mappings:
+                    raise AbortScript("Cabling enabled but patch plan is empty. Add at least one mapping line.")
+
+                # Build lookup for A-side interfaces on the newly created device
+                a_if_by_name = {i.name: i for i in interfaces}
+                b_devs, b_ifaces = self._fetch_b_side_interfaces(mappings)
+
+                created = 0
+                skipped = 0
+
+                for a_name, b_dev_name, b_if_name in mappings:
+                    a_iface = a_if_by_name.get(a_name)
+                    if not a_iface:
+                        raise AbortScript(
+                            f"A-side interface '{a_name}' not found on new device '{device.name}'. "
+                            "Check the interface name matches exactly in NetBox."
+                        )
+
+                    # Find B-side device by name
+                    b_dev = b_devs.get(b_dev_name)
+                    if not b_dev:
+                        raise AbortScript(f"B-side device '{b_dev_name}' not found in NetBox.")
+
+                    if enforce_site_match and b_dev.site_id != site.id:
+                        raise AbortScript(
+                            f"B-side device '{b_dev.name}' is in site '{b_dev.site}', not '{site}'."
+                        )
+
+                    # Find B-side interface
+                    b_iface = b_ifaces.get((b_dev.pk, b_if_name))
+                    if not b_iface:
+                        raise AbortScript(
+                            f"B-side interface '{b_if_name}' not found on device '{b_dev.name}'. "
+                            "Check interface name matches exactly in NetBox."
+                        )
+
+                    # Create cable
+                    ok = self._create_cable(a_iface, b_iface)
+                    if ok:
+                        created += 1
+                    else:
+                        skipped += 1
+
+                self.log_info(f"Patch plan cabling summary: created={created}, skipped={skipped}")
+
+            return f"Commissioning complete for {device.name}."